@@ -1,9 +1,27 @@
+import multiprocessing
 import os
-from io import StringIO
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
 
 import pandas as pd
 import numpy as np
-import psycopg2
+import psycopg
+from numba import njit
+
+from utils.pg_binary import (
+    NULL_FIELD,
+    create_asset_codes,
+    encode_date,
+    encode_fixed_rows,
+    encode_float8_array,
+    encode_text,
+    group_fields_by_width,
+    parse_fixed_rows,
+    pg_days_to_datetime64,
+    read_copy,
+    write_copy,
+)
 
 # ---------------------------------------------------
 # 1. Database connection parameters
@@ -16,119 +34,340 @@ HOST = "127.0.0.1"     # force TCP on localhost
 PORT = "5432"
 DBNAME = "crypto_sql"
 
-PASSWORD = os.environ.get("PGPASSWORD")   # must be set externally
+min_days_per_asset = 10  # minimum number of daily points per month per asset
+var_rtol = 1e-10         # variance below var_rtol * E[x**2] counts as constant
 
-if PASSWORD is None:
-    raise ValueError(
-        "Environment variable PGPASSWORD is not set. "
-        "Set it in PowerShell, e.g.:  $env:PGPASSWORD = 'your_password'"
-    )
+# Binary TEXT fields of every asset address, indexed by asset code. Encoded
+# once in the main process and handed to each worker by init_worker(),
+# which groups them by width for encode_rows().
+asset_fields = None
+
+
+def init_worker(fields):
+    global asset_fields
+    asset_fields = group_fields_by_width(fields)
 
-# psycopg2 connection (used for both reading and writing)
-conn = psycopg2.connect(
-    dbname=DBNAME,
-    user=USER,
-    password=PASSWORD,
-    host=HOST,
-    port=PORT,
-)
 
 # ---------------------------------------------------
-# 2. Load daily log-returns from database
+# 2. Per-month correlation computation
 # ---------------------------------------------------
-query = """
-SELECT asset_address, day, log_return
-FROM ohlc_daily
-WHERE log_return IS NOT NULL
-"""
+@njit(cache=True)
+def mask_and_fill(R, min_count):
+    """Two passes over the (days × assets) return block R.
 
-df = pd.read_sql(query, conn)
+    The first accumulates, per asset, the number of observed days and the
+    sum and sum of squares of the returns. The second writes, for the
+    assets observed on at least min_count days and in the float32 the GEMMs
+    below run in, the 0/1 presence mask M, the returns X centred on each
+    asset's mean and their squares X2 (all zero on missing days).
 
-df["day"] = pd.to_datetime(df["day"])
-df["month"] = df["day"].dt.to_period("M").dt.to_timestamp()
+    Returns (keep, mean squares of the kept assets, M, X, X2), instead of
+    separate isnan / sum / where / centring / astype / column-filter passes
+    over R. Months already run in parallel processes, so the kernel itself
+    is serial; fastmath is left off because it would fold the NaN test away.
+    """
+    n_days, n_assets = R.shape
+    counts = np.zeros(n_assets, dtype=np.int64)
+    sums = np.zeros(n_assets, dtype=np.float64)
+    sq_sums = np.zeros(n_assets, dtype=np.float64)
 
-# ---------------------------------------------------
-# 3. Compute monthly correlations
-# ---------------------------------------------------
-min_days_per_asset = 10  # minimum number of daily points per month per asset
-records = []
+    for i in range(n_days):
+        for j in range(n_assets):
+            x = R[i, j]
+            if not np.isnan(x):
+                counts[j] += 1
+                sums[j] += x
+                sq_sums[j] += x * x
 
-for month, df_month in df.groupby("month"):
-    # Pivot: rows = days, columns = assets, values = log_returns
-    pivot = df_month.pivot(index="day", columns="asset_address", values="log_return")
+    keep = counts >= min_count
+    kept = np.flatnonzero(keep)
+    means = sums[kept] / counts[kept]
+    mean_sqs = sq_sums[kept] / counts[kept]
 
-    # Filter out assets with insufficient data in this month
-    valid_counts = pivot.count()
-    keep_cols = valid_counts[valid_counts >= min_days_per_asset].index
-    pivot = pivot[keep_cols]
+    n_kept = kept.size
+    M = np.zeros((n_days, n_kept), dtype=np.float32)
+    X = np.zeros((n_days, n_kept), dtype=np.float32)
+    X2 = np.zeros((n_days, n_kept), dtype=np.float32)
+    for i in range(n_days):
+        for c in range(n_kept):
+            x = R[i, kept[c]]
+            if not np.isnan(x):
+                x -= means[c]
+                M[i, c] = 1.0
+                X[i, c] = x
+                X2[i, c] = x * x
 
-    # If fewer than 2 assets survive, skip this month
-    if pivot.shape[1] < 2:
-        continue
+    return keep, mean_sqs, M, X, X2
 
-    # Asset × asset correlation matrix
-    corr_matrix = pivot.corr()
 
-    # Give distinct names to the row and column axes to avoid
-    # duplicate column names when resetting index.
-    corr_matrix.index.name = "asset_i"
-    corr_matrix.columns.name = "asset_j"
+# Months are independent of each other, so this function only depends on
+# its argument: it runs in worker processes and returns the month already
+# encoded in binary COPY format.
 
-    # Convert to long format: columns = [asset_i, asset_j, corr]
-    corr_long = corr_matrix.stack().reset_index(name="corr")
+def process_month(month_group):
+    """Compute one month of correlations.
 
-    # Remove self-correlations
-    corr_long = corr_long[corr_long["asset_i"] != corr_long["asset_j"]]
+    month_group is a (month_key, df_month) pair from df.groupby("month_key").
+    Returns (n_rows, payload), payload being the rows in binary COPY format.
+    """
+    month_key, df_month = month_group
+    month = date(month_key // 12, month_key % 12 + 1, 1)
 
-    # Add month
-    corr_long["month"] = month
+    # Pivot to a dense float64 block: rows = days, columns = asset codes
+    pivot = df_month.pivot(index="day", columns="asset_code", values="log_return")
+    R = pivot.to_numpy(dtype=np.float64)
+    codes = pivot.columns.to_numpy()
 
-    records.append(corr_long)
+    # Assets with insufficient data in this month are filtered out. The
+    # returns of the others are centred on each asset's own monthly mean
+    # (observed days only; missing days stay 0). Correlations do not change
+    # under a per-asset shift, but the sums below then no longer cancel
+    # against large mean terms, which is what keeps the float32 GEMMs
+    # accurate. col_msq is the raw second moment E[x**2] of each asset.
+    keep, col_msq, M, X, X2 = mask_and_fill(R, min_days_per_asset)
+    codes = codes[keep]
 
-if records:
-    monthly_corr = pd.concat(records, ignore_index=True)
-else:
-    monthly_corr = pd.DataFrame(columns=["asset_i", "asset_j", "corr", "month"])
+    # If fewer than 2 assets survive, nothing to write for this month
+    if len(codes) < 2:
+        return 0, b""
 
-# Ensure 'month' is a plain date object for PostgreSQL DATE
-if not monthly_corr.empty:
-    monthly_corr["month"] = pd.to_datetime(monthly_corr["month"]).dt.date
-    # Reorder columns to a fixed order
-    monthly_corr = monthly_corr[["month", "asset_i", "asset_j", "corr"]]
+    # Asset × asset correlation matrix (pairwise-complete Pearson).
+    # With X = centred returns zero-filled, X2 = their squares and M = 0/1
+    # presence mask, every pairwise sum over the days both assets were
+    # observed is a GEMM:
+    #   n[i, j]   = days where both i and j are present
+    #   s[i, j]   = sum of x_i over those days
+    #   ss[i, j]  = sum of x_i**2 over those days
+    #   sxy[i, j] = sum of x_i * x_j over those days
+    #
+    # All four run as single-precision GEMMs (SGEMM: twice the SIMD width
+    # and half the memory traffic of DGEMM). Day counts are small integers,
+    # exact in float32, and on centred data a month of ~30 terms per sum
+    # keeps the float32 rounding around 1e-7 on the correlations. The
+    # results are widened to float64 for the corrections below.
+    n = (M.T @ M).astype(np.float64)
+    s = (X.T @ M).astype(np.float64)
+    ss = (X2.T @ M).astype(np.float64)
+    sxy = (X.T @ X).astype(np.float64)
 
-# ---------------------------------------------------
-# 4. Write correlation data to PostgreSQL using COPY
-# ---------------------------------------------------
-cur = conn.cursor()
-
-# Drop and recreate the target table
-cur.execute("""
-    DROP TABLE IF EXISTS monthly_correlations;
-    CREATE TABLE monthly_correlations (
-        month      DATE NOT NULL,
-        asset_i    TEXT NOT NULL,
-        asset_j    TEXT NOT NULL,
-        corr       DOUBLE PRECISION
-    );
-""")
-
-if not monthly_corr.empty:
-    # Convert the DataFrame to CSV in memory (without header)
-    buffer = StringIO()
-    monthly_corr.to_csv(buffer, index=False, header=False)
-    buffer.seek(0)
-
-    # Use COPY for fast bulk insert
-    copy_sql = """
-        COPY monthly_correlations (month, asset_i, asset_j, corr)
-        FROM STDIN WITH (FORMAT csv)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_i = s / n
+        var_i = ss / n - mean_i**2
+        cov = sxy / n - mean_i * mean_i.T
+        C = cov / np.sqrt(var_i * var_i.T)
+
+    # Pairs that overlap on too few days get no correlation
+    C[n < min_days_per_asset] = np.nan
+
+    # A series that is constant over the overlap (e.g. a fixed non-zero
+    # return) has no correlation: its variance is rounding noise, tiny next
+    # to E[x**2]. What is left is float32 rounding, clipped back to [-1, 1]
+    # (identical series would otherwise come out slightly above 1).
+    flat = var_i <= var_rtol * col_msq[:, None]
+    C[flat | flat.T] = np.nan
+    np.clip(C, -1.0, 1.0, out=C)
+
+    # Long format, unique pairs only: corr(i, j) == corr(j, i), so keep the
+    # strict upper triangle (i < j), which also drops self-correlations.
+    iu_i, iu_j = np.triu_indices(len(codes), k=1)
+    corr = C[iu_i, iu_j]
+
+    return len(corr), encode_rows(month, codes[iu_i], codes[iu_j], corr)
+
+
+def encode_rows(month, codes_i, codes_j, corr):
+    """Encode (month, asset_i, asset_j, corr) rows in binary COPY format.
+
+    Asset codes are mapped back to their (pre-encoded) addresses only here.
+    The rows are built with NumPy, a block of equally sized tuples at a
+    time: the table has no row order, so rows are grouped by the widths of
+    their two address fields and by whether corr is NULL, which fixes the
+    size of every tuple of a group.
+    """
+    widths, field_rows, tables = asset_fields
+    width_i, width_j = widths[codes_i], widths[codes_j]
+    is_null = np.isnan(corr)
+
+    group = (width_i * (widths.max() + 1) + width_j) * 2 + is_null
+    order = np.argsort(group, kind="stable")
+    _, group_starts = np.unique(group[order], return_index=True)
+    group_ends = np.append(group_starts[1:], len(order))
+
+    # The month is the same on every row
+    month_field = np.frombuffer(encode_date(month), dtype=np.uint8)[None, :]
+    null_field = np.frombuffer(NULL_FIELD, dtype=np.uint8)[None, :]
+
+    blocks = []
+    for start, end in zip(group_starts.tolist(), group_ends.tolist()):
+        rows = order[start:end]
+        first = rows[0]
+        if is_null[first]:
+            corr_field = null_field
+        else:
+            corr_field = encode_float8_array(corr[rows])
+        blocks.append(
+            encode_fixed_rows(
+                [
+                    month_field,
+                    tables[width_i[first]][field_rows[codes_i[rows]]],
+                    tables[width_j[first]][field_rows[codes_j[rows]]],
+                    corr_field,
+                ]
+            )
+        )
+    return b"".join(blocks)
+
+
+def map_bounded(executor, fn, items, window):
+    """Like executor.map(fn, items), but with at most `window` tasks in flight.
+
+    Executor.map submits every item up front (before Python 3.14), so the
+    parent would hold every month's data plus any results queued behind a
+    slow month. Here the next item is only submitted once the oldest result
+    has been consumed, keeping memory at O(window × month).
     """
-    cur.copy_expert(copy_sql, buffer)
+    pending = deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def main():
+    password = os.environ.get("PGPASSWORD")   # must be set externally
+
+    if password is None:
+        raise ValueError(
+            "Environment variable PGPASSWORD is not set. "
+            "Set it in PowerShell, e.g.:  $env:PGPASSWORD = 'your_password'"
+        )
+
+    # psycopg (v3) connection (used for both reading and writing)
+    conn = psycopg.connect(
+        dbname=DBNAME,
+        user=USER,
+        password=password,
+        host=HOST,
+        port=PORT,
+    )
+
+    # ---------------------------------------------------
+    # 3. Load daily log-returns from database
+    # ---------------------------------------------------
+    cur = conn.cursor()
+
+    # Number the asset addresses on the server, so that every row of the
+    # COPY below has a fixed width; the addresses are downloaded once here.
+    create_asset_codes(cur, """
+        SELECT asset_address AS asset
+        FROM ohlc_daily
+        WHERE log_return IS NOT NULL
+    """)
+    cur.execute("SELECT asset FROM asset_codes ORDER BY asset_code")
+    asset_names = np.array([row[0] for row in cur.fetchall()], dtype=object)
+
+    query = """
+    SELECT c.asset_code, d.day::date, d.log_return::float8
+    FROM ohlc_daily AS d
+    JOIN asset_codes AS c ON c.asset = d.asset_address
+    WHERE d.log_return IS NOT NULL
+    """
+
+    # Binary COPY straight into typed arrays (int4 code, date, float8)
+    asset_codes, days, log_returns = parse_fixed_rows(
+        read_copy(cur, query), [">i4", ">i4", ">f8"]
+    )
+
+    # Assets are carried as their int32 codes: pivots and groupbys never hash
+    # address strings. Codes follow the address order, so the i < j pairs
+    # written below still satisfy asset_i < asset_j.
+    df = pd.DataFrame(
+        {
+            "asset_code": asset_codes,
+            "day": pg_days_to_datetime64(days),
+            "log_return": log_returns,
+        }
+    )
+
+    # Integer month key (year * 12 + month - 1): grouping on an int32 column
+    # is much cheaper than building Period / Timestamp month labels.
+    year = df["day"].dt.year.to_numpy(np.int32)
+    month = df["day"].dt.month.to_numpy(np.int32)
+    df["month_key"] = year * 12 + month - 1
+
+    # ---------------------------------------------------
+    # 4. Create the target table
+    # ---------------------------------------------------
+    # Drop and recreate the target table
+    cur.execute("""
+        DROP TABLE IF EXISTS monthly_correlations;
+        CREATE TABLE monthly_correlations (
+            month      DATE NOT NULL,
+            asset_i    TEXT NOT NULL,
+            asset_j    TEXT NOT NULL,
+            corr       DOUBLE PRECISION
+        );
+    """)
+
+    # ---------------------------------------------------
+    # 5. Compute monthly correlations in parallel and stream them with COPY
+    # ---------------------------------------------------
+    # Months are spread over one worker process per CPU (capped at 61, the
+    # executor's limit on Windows). Their encoded rows are handed to a single
+    # COPY as they come back, with at most two months per worker submitted
+    # ahead, so memory stays at a few months per worker. The table has no
+    # row order, so months are taken in order of first appearance
+    # (sort=False) instead of sorting the month keys.
+    #
+    # The parallelism is across processes, so each worker's BLAS gets a
+    # single thread (otherwise cpu_count workers each start cpu_count BLAS
+    # threads). The limits are read when numpy is first imported, which is
+    # why workers are spawned into the updated environment rather than
+    # forked from this process, whose BLAS is already running.
+    os.environ.update(
+        OMP_NUM_THREADS="1", OPENBLAS_NUM_THREADS="1", MKL_NUM_THREADS="1"
+    )
+    n_workers = min(os.cpu_count() or 1, 61)
+    rows_inserted = 0
+
+    def copy_chunks(results):
+        nonlocal rows_inserted
+        for n_rows, payload in results:
+            rows_inserted += n_rows
+            yield payload
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=([encode_text(a) for a in asset_names],),
+    ) as executor:
+        results = map_bounded(
+            executor,
+            process_month,
+            df.groupby("month_key", sort=False),
+            window=2 * n_workers,
+        )
+
+        # Use binary COPY for fast bulk insert
+        copy_sql = """
+            COPY monthly_correlations (month, asset_i, asset_j, corr)
+            FROM STDIN WITH (FORMAT binary)
+        """
+        write_copy(cur, copy_sql, copy_chunks(results))
+
+    # Commit changes and close
+    conn.commit()
+    cur.close()
+    conn.close()
+
+    print("Done building monthly_correlations.")
+    print("Rows inserted:", rows_inserted)
 
-# Commit changes and close
-conn.commit()
-cur.close()
-conn.close()
 
-print("Done building monthly_correlations.")
-print("Rows inserted:", len(monthly_corr))
+# The __main__ guard is required by ProcessPoolExecutor: worker processes
+# import this module and must not reconnect to the database or rerun the job.
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,21 @@
 import os
-from io import StringIO
 from pathlib import Path
 
 import pandas as pd
 import numpy as np
-import psycopg2
-import networkx as nx
-import matplotlib.pyplot as plt
+import psycopg
+from psycopg import sql
+from numba import njit, prange
+from scipy.sparse import csr_matrix
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from utils.pg_binary import (
+    create_asset_codes,
+    parse_fixed_rows,
+    pg_days_to_datetime64,
+    read_copy,
+)
 
 # ---------------------------------------------------
 # 1. Database connection parameters
@@ -19,23 +28,6 @@ HOST = "127.0.0.1"
 PORT = "5432"
 DBNAME = "crypto_sql"
 
-PASSWORD = os.environ.get("PGPASSWORD")   # must be set externally
-
-if PASSWORD is None:
-    raise ValueError(
-        "Environment variable PGPASSWORD is not set. "
-        "Set it in PowerShell, e.g.:  $env:PGPASSWORD = 'your_password'"
-    )
-
-# psycopg2 connection (used for both reading and writing)
-conn = psycopg2.connect(
-    dbname=DBNAME,
-    user=USER,
-    password=PASSWORD,
-    host=HOST,
-    port=PORT,
-)
-
 # ---------------------------------------------------
 # 2. Configuration: correlation threshold and output paths
 # ---------------------------------------------------
@@ -45,169 +37,304 @@ CORR_THRESHOLD = 0.5
 
 # Directory for figures / reports
 REPORTS_DIR = Path("reports")
-REPORTS_DIR.mkdir(exist_ok=True, parents=True)
 
 # ---------------------------------------------------
-# 3. Load monthly correlations from database
+# 3. Graph kernels (Numba, CSR adjacency)
 # ---------------------------------------------------
-query = """
-SELECT month, asset_i, asset_j, corr
-FROM monthly_correlations
-WHERE corr IS NOT NULL
-"""
-
-df = pd.read_sql(query, conn)
-
-# Ensure month is a proper datetime
-df["month"] = pd.to_datetime(df["month"])
+# Each monthly graph is stored as a SciPy CSR adjacency matrix: the
+# neighbours of node v are indices[indptr[v]:indptr[v + 1]], sorted in
+# increasing order. Triangles are counted with the kernel below rather
+# than with (A @ A).multiply(A), which would materialise every 2-hop path.
+
+@njit(parallel=True, cache=True)
+def clustering_csr(indptr, indices):
+    """Local clustering coefficient of every node of an undirected graph.
+
+    For each node v, T_v (number of edges among the neighbours of v) is
+    obtained by intersecting the sorted neighbour list of v with the one of
+    each neighbour u (two-pointer merge). Every such edge is seen twice, so
+    the sum of the intersections is 2 * T_v and C_v = 2 * T_v / (d_v * (d_v - 1)).
+    """
+    n = indptr.size - 1
+    clustering = np.zeros(n, dtype=np.float64)
+
+    for v in prange(n):
+        v_start, v_end = indptr[v], indptr[v + 1]
+        d = v_end - v_start
+        if d < 2:
+            continue
+
+        twice_triangles = 0
+        for a in range(v_start, v_end):
+            u = indices[a]
+            p, p_end = v_start, v_end
+            q, q_end = indptr[u], indptr[u + 1]
+            while p < p_end and q < q_end:
+                x, y = indices[p], indices[q]
+                if x == y:
+                    twice_triangles += 1
+                    p += 1
+                    q += 1
+                elif x < y:
+                    p += 1
+                else:
+                    q += 1
+
+        clustering[v] = twice_triangles / (d * (d - 1))
+
+    return clustering
+
+
+@njit(cache=True)
+def _find_root(parent, x):
+    # Path halving: point every visited node to its grandparent
+    while parent[x] != x:
+        parent[x] = parent[parent[x]]
+        x = parent[x]
+    return x
+
+
+@njit(cache=True)
+def lcc_size(n, src, dst):
+    """Size of the largest connected component, via union-find on the edges.
+
+    Union by rank plus path halving keeps the trees shallow, so the whole
+    edge list is processed in O(E * alpha(n)).
+    """
+    parent = np.arange(n)
+    rank = np.zeros(n, dtype=np.int32)
+    for k in range(src.size):
+        root_i = _find_root(parent, src[k])
+        root_j = _find_root(parent, dst[k])
+        if root_i == root_j:
+            continue
+        # Attach the shallower tree under the deeper one
+        if rank[root_i] < rank[root_j]:
+            parent[root_i] = root_j
+        elif rank[root_i] > rank[root_j]:
+            parent[root_j] = root_i
+        else:
+            parent[root_j] = root_i
+            rank[root_i] += 1
+
+    sizes = np.zeros(n, dtype=np.int64)
+    for v in range(n):
+        sizes[_find_root(parent, v)] += 1
+    return sizes.max()
+
+
+def main():
+    password = os.environ.get("PGPASSWORD")   # must be set externally
+
+    if password is None:
+        raise ValueError(
+            "Environment variable PGPASSWORD is not set. "
+            "Set it in PowerShell, e.g.:  $env:PGPASSWORD = 'your_password'"
+        )
 
-# ---------------------------------------------------
-# 4. Build monthly graphs and compute network metrics
-# ---------------------------------------------------
-records = []
-
-for month, df_month in df.groupby("month"):
-    # Filter edges by absolute correlation threshold
-    df_edges = df_month[np.abs(df_month["corr"]) >= CORR_THRESHOLD]
-
-    # If there are no edges above the threshold, skip this month
-    if df_edges.empty:
-        continue
-
-    # Build an undirected graph
-    G = nx.Graph()
-
-    # Add edges with weight = correlation
-    for _, row in df_edges.iterrows():
-        G.add_edge(row["asset_i"], row["asset_j"], weight=row["corr"])
-
-    n_nodes = G.number_of_nodes()
-    n_edges = G.number_of_edges()
-
-    if n_nodes == 0:
-        # Nothing to compute for this month
-        continue
-
-    # Basic metrics
-    density = nx.density(G)
-
-    degrees = np.array([d for _, d in G.degree()])
-    avg_degree = float(degrees.mean()) if len(degrees) > 0 else 0.0
-    max_degree = int(degrees.max()) if len(degrees) > 0 else 0
-
-    # Average clustering coefficient
-    clustering_dict = nx.clustering(G, weight=None)
-    avg_clustering = float(np.mean(list(clustering_dict.values()))) if clustering_dict else 0.0
-
-    # Size of the largest connected component
-    lcc_size = len(max(nx.connected_components(G), key=len))
-
-    records.append(
-        {
-            "month": month.date(),   # store as plain date
-            "n_assets": n_nodes,
-            "n_edges": n_edges,
-            "density": density,
-            "avg_degree": avg_degree,
-            "max_degree": max_degree,
-            "avg_clustering": avg_clustering,
-            "lcc_size": lcc_size,
-        }
+    # psycopg (v3) connection (used for both reading and writing)
+    conn = psycopg.connect(
+        dbname=DBNAME,
+        user=USER,
+        password=password,
+        host=HOST,
+        port=PORT,
     )
 
-if records:
-    metrics_df = pd.DataFrame(records)
-    metrics_df = metrics_df.sort_values("month").reset_index(drop=True)
-else:
-    metrics_df = pd.DataFrame(
-        columns=[
-            "month",
-            "n_assets",
-            "n_edges",
-            "density",
-            "avg_degree",
-            "max_degree",
-            "avg_clustering",
-            "lcc_size",
-        ]
+    REPORTS_DIR.mkdir(exist_ok=True, parents=True)
+
+    # ---------------------------------------------------
+    # 4. Load monthly correlations from database
+    # ---------------------------------------------------
+    cur = conn.cursor()
+
+    # Number the assets on the server, so that every row of the COPY below
+    # has a fixed width. The metrics only need node identities, so the
+    # addresses are never downloaded.
+    create_asset_codes(cur, """
+        SELECT asset_i AS asset FROM monthly_correlations
+        UNION ALL
+        SELECT asset_j FROM monthly_correlations
+    """)
+
+    # Only edges with |corr| >= CORR_THRESHOLD are transferred, and since the
+    # metrics are unweighted, not their correlation values. COPY does not
+    # take bind parameters, so the threshold is inlined as a SQL literal.
+    query = sql.SQL("""
+    SELECT m.month, ci.asset_code, cj.asset_code
+    FROM monthly_correlations AS m
+    JOIN asset_codes AS ci ON ci.asset = m.asset_i
+    JOIN asset_codes AS cj ON cj.asset = m.asset_j
+    WHERE m.corr IS NOT NULL
+      AND ABS(m.corr) >= {}
+    """).format(sql.Literal(CORR_THRESHOLD))
+
+    # Binary COPY straight into typed arrays (date, int4 codes). Assets are
+    # carried as their int32 codes, shared by all months.
+    months, codes_i, codes_j = parse_fixed_rows(
+        read_copy(cur, query), [">i4", ">i4", ">i4"]
     )
 
-# ---------------------------------------------------
-# 5. Write network metrics to PostgreSQL using COPY
-# ---------------------------------------------------
-cur = conn.cursor()
-
-cur.execute("""
-    DROP TABLE IF EXISTS temporal_network_metrics;
-    CREATE TABLE temporal_network_metrics (
-        month          DATE PRIMARY KEY,
-        n_assets       INTEGER,
-        n_edges        INTEGER,
-        density        DOUBLE PRECISION,
-        avg_degree     DOUBLE PRECISION,
-        max_degree     INTEGER,
-        avg_clustering DOUBLE PRECISION,
-        lcc_size       INTEGER
-    );
-""")
-
-if not metrics_df.empty:
-    # Prepare CSV in memory
-    buffer = StringIO()
-    metrics_df.to_csv(buffer, index=False, header=False)
-    buffer.seek(0)
-
-    copy_sql = """
-        COPY temporal_network_metrics (
-            month,
-            n_assets,
-            n_edges,
-            density,
-            avg_degree,
-            max_degree,
-            avg_clustering,
-            lcc_size
+    # Sort the column arrays by month once: each month's edges are then a
+    # contiguous slice of them, with no per-month DataFrame or column lookup.
+    order = np.argsort(months, kind="stable")
+    months, codes_i, codes_j = months[order], codes_i[order], codes_j[order]
+
+    month_starts = np.flatnonzero(np.diff(months, prepend=months[:1] - 1))
+    month_ends = np.append(month_starts[1:], len(months))
+    month_dates = pg_days_to_datetime64(months[month_starts]).astype(object)
+
+    # ---------------------------------------------------
+    # 5. Build monthly graphs and compute network metrics
+    # ---------------------------------------------------
+    records = []
+
+    # Rows are already filtered by |corr| >= CORR_THRESHOLD, so each month's
+    # rows are its edges; months without any edge do not appear at all.
+    for month, start, end in zip(month_dates, month_starts, month_ends):
+        # Relabel this month's asset codes as node ids 0..n_nodes-1
+        node_ids, nodes = pd.factorize(
+            np.concatenate([codes_i[start:end], codes_j[start:end]])
         )
-        FROM STDIN WITH (FORMAT csv)
-    """
-    cur.copy_expert(copy_sql, buffer)
+        n_nodes = len(nodes)
+        src, dst = np.split(node_ids.astype(np.int64), 2)
 
-conn.commit()
+        # monthly_correlations stores each unordered pair once
+        # (asset_i < asset_j), so the rows are already the undirected edge list
+        n_edges = len(src)
 
-# ---------------------------------------------------
-# 6. Generate simple time-series plots for key metrics
-# ---------------------------------------------------
-if not metrics_df.empty:
-    # Convert month back to datetime for plotting
-    metrics_df["month"] = pd.to_datetime(metrics_df["month"])
-
-    # Plot network density over time
-    plt.figure(figsize=(8, 4))
-    plt.plot(metrics_df["month"], metrics_df["density"], marker="o")
-    plt.xlabel("Month")
-    plt.ylabel("Network density")
-    plt.title(f"Network density over time (|corr| >= {CORR_THRESHOLD})")
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    density_path = REPORTS_DIR / "network_density_over_time.png"
-    plt.savefig(density_path)
-    plt.close()
-
-    # Plot average degree over time
-    plt.figure(figsize=(8, 4))
-    plt.plot(metrics_df["month"], metrics_df["avg_degree"], marker="o")
-    plt.xlabel("Month")
-    plt.ylabel("Average degree")
-    plt.title(f"Average degree over time (|corr| >= {CORR_THRESHOLD})")
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    degree_path = REPORTS_DIR / "average_degree_over_time.png"
-    plt.savefig(degree_path)
-    plt.close()
-
-cur.close()
-conn.close()
-
-print("Done building temporal_network_metrics.")
-print("Rows inserted:", len(metrics_df))
-print(f"Figures saved in: {REPORTS_DIR.resolve()}")
+        # Symmetric sparse adjacency matrix with sorted neighbour lists
+        A = csr_matrix(
+            (np.ones(n_edges, dtype=np.int8), (src, dst)),
+            shape=(n_nodes, n_nodes),
+        )
+        A = (A + A.T).tocsr()
+        A.sort_indices()
+        degrees = A.getnnz(axis=1)
+
+        # Basic metrics
+        density = 2.0 * n_edges / (n_nodes * (n_nodes - 1))
+
+        avg_degree = float(degrees.mean())
+        max_degree = int(degrees.max())
+
+        # Average clustering coefficient
+        avg_clustering = float(clustering_csr(A.indptr, A.indices).mean())
+
+        # Size of the largest connected component
+        lcc = int(lcc_size(n_nodes, src, dst))
+
+        records.append(
+            {
+                "month": month,   # plain datetime.date
+                "n_assets": n_nodes,
+                "n_edges": n_edges,
+                "density": density,
+                "avg_degree": avg_degree,
+                "max_degree": max_degree,
+                "avg_clustering": avg_clustering,
+                "lcc_size": lcc,
+            }
+        )
+
+    if records:
+        metrics_df = pd.DataFrame(records)
+        metrics_df = metrics_df.sort_values("month").reset_index(drop=True)
+    else:
+        metrics_df = pd.DataFrame(
+            columns=[
+                "month",
+                "n_assets",
+                "n_edges",
+                "density",
+                "avg_degree",
+                "max_degree",
+                "avg_clustering",
+                "lcc_size",
+            ]
+        )
+
+    # ---------------------------------------------------
+    # 6. Write network metrics to PostgreSQL using COPY
+    # ---------------------------------------------------
+    cur.execute("""
+        DROP TABLE IF EXISTS temporal_network_metrics;
+        CREATE TABLE temporal_network_metrics (
+            month          DATE PRIMARY KEY,
+            n_assets       INTEGER,
+            n_edges        INTEGER,
+            density        DOUBLE PRECISION,
+            avg_degree     DOUBLE PRECISION,
+            max_degree     INTEGER,
+            avg_clustering DOUBLE PRECISION,
+            lcc_size       INTEGER
+        );
+    """)
+
+    if not metrics_df.empty:
+        copy_sql = """
+            COPY temporal_network_metrics (
+                month,
+                n_assets,
+                n_edges,
+                density,
+                avg_degree,
+                max_degree,
+                avg_clustering,
+                lcc_size
+            )
+            FROM STDIN WITH (FORMAT binary)
+        """
+        # Binary COPY: psycopg encodes each row from the declared column types
+        with cur.copy(copy_sql) as copy:
+            copy.set_types(
+                ["date", "int4", "int4", "float8", "float8", "int4", "float8", "int4"]
+            )
+            for row in metrics_df.itertuples(index=False):
+                copy.write_row(row)
+
+    conn.commit()
+
+    # ---------------------------------------------------
+    # 7. Generate simple time-series plots for key metrics
+    # ---------------------------------------------------
+    if not metrics_df.empty:
+        # Convert month back to datetime for plotting
+        metrics_df["month"] = pd.to_datetime(metrics_df["month"])
+
+        # Density and average degree share the month axis: draw them as two
+        # stacked panels of a single figure, saved in one pass. The figure is
+        # rendered with the Agg canvas directly, without pyplot's global state
+        # and backend/GUI set-up.
+        fig = Figure(figsize=(8, 8))
+        canvas = FigureCanvasAgg(fig)
+        ax1, ax2 = fig.subplots(2, 1, sharex=True)
+
+        # Network density over time
+        ax1.plot(metrics_df["month"], metrics_df["density"], marker="o")
+        ax1.set_ylabel("Network density")
+        ax1.set_title(f"Network density over time (|corr| >= {CORR_THRESHOLD})")
+
+        # Average degree over time
+        ax2.plot(metrics_df["month"], metrics_df["avg_degree"], marker="o")
+        ax2.set_xlabel("Month")
+        ax2.set_ylabel("Average degree")
+        ax2.set_title(f"Average degree over time (|corr| >= {CORR_THRESHOLD})")
+        ax2.tick_params(axis="x", labelrotation=45)
+
+        fig.tight_layout()
+        metrics_path = REPORTS_DIR / "network_metrics.png"
+        canvas.print_png(metrics_path)
+
+    cur.close()
+    conn.close()
+
+    print("Done building temporal_network_metrics.")
+    print("Rows inserted:", len(metrics_df))
+    print(f"Figures saved in: {REPORTS_DIR.resolve()}")
+
+
+# Running the script builds the metrics; importing it (e.g. to test the
+# graph kernels) does not connect to the database.
+if __name__ == "__main__":
+    main()
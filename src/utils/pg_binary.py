@@ -0,0 +1,223 @@
+import math
+import struct
+from datetime import date
+from io import BytesIO
+
+import numpy as np
+from psycopg import sql
+
+# ---------------------------------------------------
+# PostgreSQL binary COPY format (COPY ... WITH (FORMAT BINARY))
+# ---------------------------------------------------
+# A binary COPY stream is:
+#   header  : 11-byte signature + int32 flags + int32 header-extension length
+#   tuples  : int16 field count, then for each field an int32 byte length
+#             followed by the value in network byte order (length -1 = NULL)
+#   trailer : int16 -1
+#
+# Moving values in binary form avoids formatting every float as text on one
+# side of the connection and parsing it back on the other.
+
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_TRAILER = struct.pack("!h", -1)
+
+# DATE values are sent as int32 days since the PostgreSQL epoch
+PG_EPOCH = date(2000, 1, 1)
+PG_EPOCH_NP = np.datetime64(PG_EPOCH, "D")
+
+NULL_FIELD = struct.pack("!i", -1)
+
+_FIELD_COUNT = struct.Struct("!h")
+_INT4_FIELD = struct.Struct("!ii")
+_FLOAT8_FIELD = struct.Struct("!id")
+
+
+# ---------------------------------------------------
+# Writing: COPY ... FROM STDIN
+# ---------------------------------------------------
+# For small tables, psycopg's Copy.write_row() with set_types() does the
+# binary encoding. The encoders below are for hot paths that build whole
+# blocks of rows themselves (e.g. in worker processes) and send them with
+# write_copy(): the scalar ones for single fields, the array ones to encode
+# a block of equally sized tuples with NumPy, without a Python call per row.
+
+def encode_date(value):
+    """Encode a datetime.date as a binary DATE field."""
+    return _INT4_FIELD.pack(4, (value - PG_EPOCH).days)
+
+
+def encode_float8(value):
+    """Encode a float as a binary DOUBLE PRECISION field (NaN -> NULL)."""
+    value = float(value)
+    if math.isnan(value):
+        return NULL_FIELD
+    return _FLOAT8_FIELD.pack(8, value)
+
+
+def encode_text(value):
+    """Encode a string as a binary TEXT field (UTF-8)."""
+    data = str(value).encode("utf-8")
+    return struct.pack("!i", len(data)) + data
+
+
+def field_count(n_fields):
+    """Int16 field-count prefix of a tuple with n_fields columns."""
+    return _FIELD_COUNT.pack(n_fields)
+
+
+def encode_float8_array(values):
+    """Encode a float array as binary DOUBLE PRECISION fields.
+
+    Returns an (n, 12) uint8 array, one complete field per row, for
+    encode_fixed_rows(). NaN is encoded as a value here: NULLs have another
+    width, so callers select those rows out and encode them as NULL_FIELD.
+    """
+    values = np.asarray(values, dtype=">f8")
+    fields = np.empty((values.size, 12), dtype=np.uint8)
+    fields[:, :4] = np.frombuffer(struct.pack("!i", 8), dtype=np.uint8)
+    fields[:, 4:] = values.reshape(-1, 1).view(np.uint8)
+    return fields
+
+
+def group_fields_by_width(fields):
+    """Group pre-encoded fields (a list of bytes) by width.
+
+    Returns (widths, rows, tables): field k is row rows[k] of
+    tables[widths[k]], an (n, width) uint8 array. Gathering rows of those
+    tables with fancy indexing gives the columns of encode_fixed_rows().
+    """
+    widths = np.array([len(field) for field in fields], dtype=np.int64)
+    rows = np.zeros(len(fields), dtype=np.int64)
+    tables = {}
+    for width in np.unique(widths).tolist():
+        members = np.flatnonzero(widths == width)
+        rows[members] = np.arange(members.size)
+        tables[width] = np.frombuffer(
+            b"".join(fields[k] for k in members.tolist()), dtype=np.uint8
+        ).reshape(members.size, width)
+    return widths, rows, tables
+
+
+def encode_fixed_rows(columns):
+    """Encode tuples whose fields all have a fixed width (see parse_fixed_rows).
+
+    columns holds one (n_rows, width) uint8 array per column, each row a
+    complete encoded field (length prefix included); a (1, width) array
+    repeats the same field on every row. Returns the tuples as bytes.
+    """
+    n_rows = max(column.shape[0] for column in columns)
+    row_dtype = np.dtype(
+        [("n_fields", ">i2")]
+        + [(f"field_{k}", np.uint8, (column.shape[1],)) for k, column in enumerate(columns)]
+    )
+    rows = np.empty(n_rows, dtype=row_dtype)
+    rows["n_fields"] = len(columns)
+    for k, column in enumerate(columns):
+        rows[f"field_{k}"] = column
+    return rows.tobytes()
+
+
+def write_copy(cur, statement, chunks):
+    """Run a binary COPY ... FROM STDIN fed with pre-encoded blocks of rows.
+
+    chunks is any iterable of bytes (e.g. a generator), consumed lazily so
+    a single COPY can stream an arbitrarily large table. The header and the
+    trailer are added here: psycopg sends blocks passed to Copy.write() as
+    they are.
+    """
+    with cur.copy(statement) as copy:
+        copy.write(COPY_HEADER)
+        for chunk in chunks:
+            copy.write(chunk)
+        copy.write(COPY_TRAILER)
+
+
+# ---------------------------------------------------
+# Reading: COPY (...) TO STDOUT
+# ---------------------------------------------------
+# When every column has a fixed width (no TEXT/NUMERIC, no NULLs), every
+# tuple has the same size and the whole payload can be viewed as a NumPy
+# structured array: no Python object is created per row.
+
+def pg_days_to_datetime64(days):
+    """Convert an array of binary DATE values (days since 2000-01-01)."""
+    return PG_EPOCH_NP + np.asarray(days).astype("timedelta64[D]")
+
+
+def create_asset_codes(cur, source):
+    """Number assets on the server, in a TEMP table asset_codes(asset, asset_code).
+
+    Asset addresses are the only variable-width columns of the pipeline:
+    joining queries against this table replaces them with int4 codes, so
+    that every row of a COPY ... TO STDOUT has a fixed width. source is a
+    SELECT (a string or a psycopg.sql.Composable) returning the addresses
+    in a column named asset; duplicates are fine. Codes run from 0 in
+    address order, so comparing two codes compares the addresses.
+    """
+    if isinstance(source, str):
+        source = sql.SQL(source)
+    cur.execute(
+        sql.SQL("""
+        CREATE TEMP TABLE asset_codes AS
+        SELECT
+            asset,
+            (ROW_NUMBER() OVER (ORDER BY asset) - 1)::int4 AS asset_code
+        FROM (SELECT DISTINCT asset FROM ({}) AS s) AS a
+        """).format(source)
+    )
+
+
+def read_copy(cur, query):
+    """Run COPY (query) TO STDOUT in binary format and return the payload.
+
+    query is a string or a psycopg.sql.Composable.
+    """
+    if isinstance(query, str):
+        query = sql.SQL(query)
+    statement = sql.SQL("COPY ({}) TO STDOUT WITH (FORMAT binary)").format(query)
+
+    buffer = BytesIO()
+    with cur.copy(statement) as copy:
+        for data in copy:
+            buffer.write(data)
+    return buffer.getvalue()
+
+
+def parse_fixed_rows(data, field_dtypes):
+    """Parse a binary COPY payload into one NumPy array per column.
+
+    field_dtypes are the big-endian dtypes of the columns, e.g.
+    [">i4", ">f8"] for (INTEGER, DOUBLE PRECISION); DATE columns are ">i4".
+    Raises ValueError if the payload does not match (e.g. it has NULLs).
+    """
+    signature = COPY_HEADER[:11]
+    if data[:11] != signature:
+        raise ValueError("binary COPY payload doesn't start with the PGCOPY signature")
+    (ext_length,) = struct.unpack_from("!i", data, 15)
+    body_start = 19 + ext_length
+
+    if data[-2:] != COPY_TRAILER:
+        raise ValueError("binary COPY payload doesn't end with the trailer")
+    body = memoryview(data)[body_start:-2]
+
+    field_dtypes = [np.dtype(dt) for dt in field_dtypes]
+    row_dtype = np.dtype(
+        [("n_fields", ">i2")]
+        + [
+            item
+            for k, dt in enumerate(field_dtypes)
+            for item in ((f"length_{k}", ">i4"), (f"field_{k}", dt))
+        ]
+    )
+    if len(body) % row_dtype.itemsize:
+        raise ValueError("binary COPY payload has variable-width or NULL fields")
+    rows = np.frombuffer(body, dtype=row_dtype)
+
+    if np.any(rows["n_fields"] != len(field_dtypes)):
+        raise ValueError("unexpected number of fields in binary COPY payload")
+    for k, dt in enumerate(field_dtypes):
+        if np.any(rows[f"length_{k}"] != dt.itemsize):
+            raise ValueError(f"unexpected width (or NULL) in column {k} of binary COPY payload")
+
+    # Copy each column out in native byte order
+    return [rows[f"field_{k}"].astype(dt.newbyteorder("=")) for k, dt in enumerate(field_dtypes)]
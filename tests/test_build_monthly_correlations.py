@@ -0,0 +1,58 @@
+import struct
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+import build_monthly_correlations as bmc  # noqa: E402
+from utils.pg_binary import encode_text  # noqa: E402
+
+
+def run_month(series):
+    """Run process_month on one month of complete series and return the
+    decoded rows as {(code_i, code_j): corr}, corr None for NULL."""
+    days = pd.date_range("2021-03-01", periods=len(series[0]))
+    df_month = pd.DataFrame(
+        {
+            "asset_code": np.repeat(np.arange(len(series), dtype=np.int32), len(days)),
+            "day": np.tile(days, len(series)),
+            "log_return": np.concatenate(series),
+        }
+    )
+    names = [f"asset{code}" for code in range(len(series))]
+    bmc.init_worker([encode_text(name) for name in names])
+    n_rows, payload = bmc.process_month((2021 * 12 + 2, df_month))
+
+    rows, pos = {}, 0
+    for _ in range(n_rows):
+        fields = []
+        pos += 2  # field count
+        for _ in range(4):
+            (length,) = struct.unpack_from(">i", payload, pos)
+            pos += 4
+            fields.append(None if length < 0 else payload[pos:pos + length])
+            pos += max(length, 0)
+        _, a_i, a_j, corr = fields
+        key = (names.index(a_i.decode()), names.index(a_j.decode()))
+        rows[key] = None if corr is None else struct.unpack(">d", corr)[0]
+    assert pos == len(payload)
+    return rows
+
+
+def test_identical_series_stay_within_one():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        x = rng.normal(0.01, 0.05, 31)
+        rows = run_month([x, x.copy(), rng.normal(0.0, 0.05, 31)])
+        assert rows[(0, 1)] <= 1.0
+        assert rows[(0, 1)] > 1.0 - 1e-6
+        assert all(-1.0 <= c <= 1.0 for c in rows.values())
+
+
+def test_constant_series_has_no_correlation():
+    rng = np.random.default_rng(1)
+    rows = run_month([np.full(31, 0.0123), rng.normal(0.0, 0.05, 31)])
+    assert rows[(0, 1)] is None
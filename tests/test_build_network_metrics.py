@@ -0,0 +1,73 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from build_network_metrics import clustering_csr, lcc_size  # noqa: E402
+
+
+def edge_arrays(edges):
+    src, dst = np.array(edges, dtype=np.int64).reshape(-1, 2).T
+    return src.copy(), dst.copy()
+
+
+def clustering(n_nodes, edges):
+    """Clustering of every node, with the adjacency built as in the script."""
+    src, dst = edge_arrays(edges)
+    A = csr_matrix(
+        (np.ones(len(src), dtype=np.int8), (src, dst)), shape=(n_nodes, n_nodes)
+    )
+    A = (A + A.T).tocsr()
+    A.sort_indices()
+    return clustering_csr(A.indptr, A.indices)
+
+
+def lcc(n_nodes, edges):
+    return lcc_size(n_nodes, *edge_arrays(edges))
+
+
+def test_clustering_triangle():
+    np.testing.assert_allclose(clustering(3, [(0, 1), (1, 2), (0, 2)]), [1, 1, 1])
+
+
+def test_clustering_complete_graph():
+    edges = [(i, j) for i in range(5) for j in range(i + 1, 5)]
+    np.testing.assert_allclose(clustering(5, edges), np.ones(5))
+
+
+def test_clustering_star_and_cycle_have_no_triangles():
+    np.testing.assert_allclose(clustering(5, [(0, 1), (0, 2), (0, 3), (0, 4)]), 0)
+    np.testing.assert_allclose(clustering(4, [(0, 1), (1, 2), (2, 3), (0, 3)]), 0)
+
+
+def test_clustering_triangle_with_pendant():
+    # Node 0 has neighbours {1, 2, 3} and one edge (1, 2) among them
+    edges = [(0, 1), (1, 2), (0, 2), (0, 3)]
+    np.testing.assert_allclose(clustering(4, edges), [1 / 3, 1, 1, 0])
+
+
+def test_clustering_two_triangles_sharing_an_edge():
+    # Nodes 1 and 2 have neighbours {0, 2, 3} / {0, 1, 3}: 2 of 3 pairs linked
+    edges = [(0, 1), (0, 2), (1, 2), (1, 3), (2, 3)]
+    np.testing.assert_allclose(clustering(4, edges), [1, 2 / 3, 2 / 3, 1])
+
+
+def test_clustering_is_zero_below_degree_two():
+    np.testing.assert_allclose(clustering(3, [(0, 1)]), [0, 0, 0])
+
+
+def test_lcc_size():
+    assert lcc(3, [(0, 1), (1, 2), (0, 2)]) == 3
+    # Path 0-1-2, edge 3-4 and an isolated node 5
+    assert lcc(6, [(0, 1), (1, 2), (3, 4)]) == 3
+    assert lcc(4, []) == 1
+
+
+def test_lcc_size_merges_components_in_any_order():
+    # Two chains built from their far ends, then joined in the middle
+    edges = [(8, 9), (7, 8), (6, 7), (5, 6), (0, 1), (1, 2), (2, 3), (3, 4), (4, 5)]
+    assert lcc(10, edges) == 10
+    assert lcc(12, edges[:4] + edges[4:8]) == 5
@@ -0,0 +1,134 @@
+import struct
+import sys
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from utils.pg_binary import (  # noqa: E402
+    COPY_HEADER,
+    COPY_TRAILER,
+    create_asset_codes,
+    parse_fixed_rows,
+    pg_days_to_datetime64,
+    read_copy,
+)
+
+
+def payload(*rows):
+    """A binary COPY payload: header, one pre-encoded tuple per row, trailer."""
+    return COPY_HEADER + b"".join(rows) + COPY_TRAILER
+
+
+def int_date_float_row(code, day, value):
+    return struct.pack("!hiiiiid", 3, 4, code, 4, day, 8, value)
+
+
+class FakeExecuteCursor:
+    """Cursor that records the statements passed to execute()."""
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, statement):
+        self.statements.append(statement)
+
+
+class FakeCopyCursor:
+    """Cursor whose COPY ... TO STDOUT yields the given blocks of data."""
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.statements = []
+
+    @contextmanager
+    def copy(self, statement):
+        self.statements.append(statement)
+        yield iter(self.blocks)
+
+
+def test_parse_fixed_rows_round_trip():
+    data = payload(
+        int_date_float_row(0, 7671, -0.25),
+        int_date_float_row(2, 7672, 1.5e-3),
+        int_date_float_row(-1, -1, 0.0),
+    )
+    codes, days, values = parse_fixed_rows(data, [">i4", ">i4", ">f8"])
+
+    np.testing.assert_array_equal(codes, [0, 2, -1])
+    np.testing.assert_array_equal(days, [7671, 7672, -1])
+    np.testing.assert_array_equal(values, [-0.25, 1.5e-3, 0.0])
+    assert codes.dtype == np.dtype("int32") and values.dtype == np.dtype("float64")
+    assert pg_days_to_datetime64(days)[0] == np.datetime64("2021-01-01")
+
+
+def test_parse_fixed_rows_empty_and_header_extension():
+    (codes,) = parse_fixed_rows(payload(), [">i4"])
+    assert codes.size == 0
+
+    # A header extension area is skipped, whatever it contains
+    header = COPY_HEADER[:15] + struct.pack("!i", 3) + b"ext"
+    data = header + struct.pack("!hii", 1, 4, 42) + COPY_TRAILER
+    (codes,) = parse_fixed_rows(data, [">i4"])
+    np.testing.assert_array_equal(codes, [42])
+
+
+def test_parse_fixed_rows_rejects_bad_framing():
+    good = payload(struct.pack("!hii", 1, 4, 1))
+    with pytest.raises(ValueError, match="signature"):
+        parse_fixed_rows(b"PGCOPX" + good[6:], [">i4"])
+    with pytest.raises(ValueError, match="trailer"):
+        parse_fixed_rows(good[:-2], [">i4"])
+
+
+def test_parse_fixed_rows_rejects_variable_width():
+    # The second row's NULL makes the body a size no row width divides
+    data = payload(struct.pack("!hiiii", 2, 4, 1, 4, 2), struct.pack("!hiii", 2, 4, 3, -1))
+    with pytest.raises(ValueError, match="variable-width or NULL"):
+        parse_fixed_rows(data, [">i4", ">i4"])
+
+
+def test_parse_fixed_rows_rejects_null_and_wrong_width():
+    # Same total size as an (int4, int4) row: NULL then an 8-byte field
+    null_row = struct.pack("!hiiq", 2, -1, 8, 5)
+    data = payload(struct.pack("!hiiii", 2, 4, 1, 4, 2), null_row)
+    with pytest.raises(ValueError, match="width \\(or NULL\\) in column 0"):
+        parse_fixed_rows(data, [">i4", ">i4"])
+
+    # An 8-byte field then a 4-byte one, where (int4, int8) is expected
+    wide_row = struct.pack("!hiqii", 2, 8, 1, 4, 2)
+    with pytest.raises(ValueError, match="width \\(or NULL\\) in column 0"):
+        parse_fixed_rows(payload(wide_row), [">i4", ">i8"])
+
+
+def test_parse_fixed_rows_rejects_field_count():
+    data = payload(struct.pack("!hiiii", 3, 4, 1, 4, 2))
+    with pytest.raises(ValueError, match="number of fields"):
+        parse_fixed_rows(data, [">i4", ">i4"])
+
+
+def test_read_copy_collects_blocks():
+    data = payload(int_date_float_row(1, 2, 3.0), int_date_float_row(4, 5, 6.0))
+    cur = FakeCopyCursor([data[:7], data[7:30], data[30:]])
+
+    assert read_copy(cur, "SELECT 1") == data
+    (statement,) = cur.statements
+    assert statement.as_string(None) == "COPY (SELECT 1) TO STDOUT WITH (FORMAT binary)"
+
+    codes, days, values = parse_fixed_rows(read_copy(cur, "SELECT 1"), [">i4", ">i4", ">f8"])
+    np.testing.assert_array_equal(codes, [1, 4])
+    np.testing.assert_array_equal(values, [3.0, 6.0])
+
+
+def test_create_asset_codes_wraps_source():
+    cur = FakeExecuteCursor()
+    create_asset_codes(cur, "SELECT asset_i AS asset FROM monthly_correlations")
+
+    (statement,) = cur.statements
+    text = " ".join(statement.as_string(None).split())
+    assert text.startswith("CREATE TEMP TABLE asset_codes AS SELECT asset,")
+    assert "(ROW_NUMBER() OVER (ORDER BY asset) - 1)::int4 AS asset_code" in text
+    assert "SELECT DISTINCT asset FROM (SELECT asset_i AS asset FROM monthly_correlations)" in text